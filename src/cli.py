@@ -4,6 +4,7 @@ This is PhoGG (Photo Gallery Generator) -
 a CLI tool to generate a static site photo gallery.
 """
 import argparse
+import os
 from pathlib import Path
 
 from photo_processor import process_photos, SUPPORTED_OUTPUT_TYPES
@@ -14,6 +15,7 @@ from site_generator import create_site_directory, generate_site
 DEFAULT_SITE_CONFIG = "site.toml"
 DEFAULT_OUTPUT_FORMAT = "JPEG"
 DEFAULT_OUTPUT_QUALITY = 80
+DEFAULT_JOBS = os.cpu_count() or 1
 
 def parse_arguments():
     """
@@ -40,6 +42,12 @@ def parse_arguments():
         "--force", "-f",
         help="force overwrite of destination directory if it exists",
         action="store_true")
+    parser.add_argument(
+        "--incremental",
+        help="reuse an existing destination directory and only convert new or changed photos "
+            "(default: on, unless --force is given)",
+        action=argparse.BooleanOptionalAction,
+        default=True)
     parser.add_argument(
         "--config", "-c",
         help=f"site configuration file (default: {DEFAULT_SITE_CONFIG})",
@@ -48,11 +56,14 @@ def parse_arguments():
         default=DEFAULT_SITE_CONFIG)
     parser.add_argument(
         "--output-format", "-o",
-        help=f"output image format (default: {DEFAULT_OUTPUT_FORMAT})",
+        help="output image formats in order of preference, "
+            "the last one is the fallback for browsers that support none of the others "
+            f"(default: {DEFAULT_OUTPUT_FORMAT}, available: {', '.join(SUPPORTED_OUTPUT_TYPES)})",
         metavar="TYPE",
         type=str,
+        nargs="+",
         choices=SUPPORTED_OUTPUT_TYPES,
-        default=DEFAULT_OUTPUT_FORMAT)
+        default=[DEFAULT_OUTPUT_FORMAT])
     parser.add_argument(
         "--output-quality", "-q",
         help=f"output image compression quality (default: {DEFAULT_OUTPUT_QUALITY})",
@@ -60,18 +71,28 @@ def parse_arguments():
         type=int,
         choices=range(0, 101),
         default=DEFAULT_OUTPUT_QUALITY)
+    parser.add_argument(
+        "--jobs", "-j",
+        help=f"number of photos to process in parallel (default: {DEFAULT_JOBS})",
+        metavar="NUMBER",
+        type=int,
+        default=DEFAULT_JOBS)
 
     return parser.parse_args()
 
 if __name__ == "__main__":
     arguments = parse_arguments()
     try:
-        destination = create_site_directory(arguments.destination, arguments.force)
+        destination = create_site_directory(
+            arguments.destination,
+            arguments.force,
+            arguments.incremental)
         photos = process_photos(
             arguments.source,
             destination,
             arguments.output_format,
-            arguments.output_quality)
+            arguments.output_quality,
+            arguments.jobs)
         generate_site(arguments.config, photos, destination)
     except Exception as error:
         print(error)
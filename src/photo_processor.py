@@ -2,38 +2,91 @@
 Photo processing module
 """
 
+import io
+import json
+import numbers
+import os
+import shutil
+import subprocess
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
+from itertools import chain
 from pathlib import Path
 from time import time
-from typing import Any, BinaryIO, Union
+from typing import Any, Callable, Iterable, Iterator, Optional, Union
 
-import filetype
+import PIL
 from PIL import Image, ExifTags
 
-SUPPORTED_INPUT_TYPES = ["image/jpeg"]
+try:
+    from turbojpeg import TurboJPEG, TJPF_GRAY, TJPF_RGB
+except ImportError:
+    TurboJPEG = None
+
+SUPPORTED_INPUT_TYPES = ["image/jpeg", "image/webp"]
 SUPPORTED_OUTPUT_TYPES = ["JPEG", "WEBP"]
+OUTPUT_MIME_TYPES = {
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+    "AVIF": "image/avif",
+    "JXL": "image/jxl",
+}
+# largest first, every copy is resized from the previous one
 TARGET_RESOLUTIONS = [(1920, 1080), (1280, 720), (640, 360), (320, 180)]
+# max-widths of the target resolutions, in the same order
+WIDTHS = tuple(width for width, _ in TARGET_RESOLUTIONS)
+# image sizes (max-width) available for every photo, ascending
+SIZES = WIDTHS[::-1]
+EXIF_TAG_NAMES = ExifTags.TAGS
+EXIF_TAGS = {
+    "DateTimeOriginal", "Make", "Model", "LensModel",
+    "FNumber", "ExposureTime", "ISOSpeedRatings", "FocalLength",
+}
+JPEGOPTIM = shutil.which("jpegoptim")
+MANIFEST_FILE_NAME = ".phogg-manifest.json"
+
+try:
+    import pillow_avif  # registers the AVIF format with Pillow
+    SUPPORTED_OUTPUT_TYPES.append("AVIF")
+except ImportError:
+    pass
+
+try:
+    import pillow_jxl  # registers the JPEG XL format with Pillow
+    SUPPORTED_OUTPUT_TYPES.append("JXL")
+except ImportError:
+    pass
+
+_SUFFIXES = {output_format: f".{output_format.lower()}" for output_format in SUPPORTED_OUTPUT_TYPES}
 
 Size = tuple[int, int]
 MaybeString = Union[str, None]
 ExifData = dict[str, Any]
+ImagePaths = dict[str, list[Path]]
+PhotoPaths = dict[str, list[str]]
 PhotoTitleAndDescription = tuple[MaybeString, MaybeString]
+ManifestEntry = dict[str, Any]
 
 class Photo:
     """ Photo container for template """
     def __init__(self,
             title_and_description: PhotoTitleAndDescription,
-            paths: dict[int, Path],
+            paths: PhotoPaths,
             exif_data: ExifData):
         self._exif = exif_data
         self._paths = paths
-        self._sizes = list(self._paths.keys())
-        self._sizes.sort()
+        self._formats = list(self._paths.keys())
         self._title, self._description = title_and_description
 
     @property
-    def sizes(self) -> list[int]:
+    def formats(self) -> list[str]:
+        """ Image formats in order of preference, the last one is the fallback """
+        return self._formats
+
+    @property
+    def sizes(self) -> tuple[int, ...]:
         """ Available image sizes (max-width) """
-        return self._sizes
+        return SIZES
 
     @property
     def default_size(self) -> int:
@@ -41,19 +94,33 @@ class Photo:
         return self.sizes[0]
 
     @property
-    def path(self) -> Path:
-        """ Image path (default size) """
-        return self._paths[self.default_size]
+    def path(self) -> str:
+        """ Image path (default size, fallback format) """
+        return self.path_for(self.default_size)
 
     @property
-    def paths(self) -> dict[int, Path]:
-        """ Image file paths for different sizes """
-        return self._paths
+    def paths(self) -> list[str]:
+        """ Image file paths for all sizes, in the order of sizes (fallback format) """
+        return self._paths[self.formats[-1]]
+
+    def path_for(self, size: int, output_format: MaybeString = None) -> str:
+        """ Image path for the given size (default: fallback format) """
+        return self._paths[output_format or self.formats[-1]][SIZES.index(size)]
+
+    def srcset(self, output_format: MaybeString = None) -> str:
+        """ Image paths of all sizes for a srcset attribute (default: fallback format) """
+        paths = self._paths[output_format or self.formats[-1]]
+        return ", ".join(f"{path} {size}w" for size, path in zip(SIZES, paths))
+
+    @property
+    def sources(self) -> list[tuple[str, str]]:
+        """ MIME type and srcset of each format preferred over the fallback format """
+        return [(OUTPUT_MIME_TYPES[f], self.srcset(f)) for f in self.formats[:-1]]
 
     @property
     def file_name(self) -> str:
         """ Image file name """
-        return self.path.name
+        return self.path.rsplit("/", 1)[-1]
 
     @property
     def title(self) -> MaybeString:
@@ -74,20 +141,46 @@ class Photo:
         return self.file_name
 
 
+def is_pillow_simd() -> bool:
+    """ Check if the SIMD optimized Pillow-SIMD fork is installed (versioned as X.Y.Z.postN) """
+    return ".post" in PIL.__version__
+
+def guess_image_type(header: bytes) -> MaybeString:
+    """
+    Guess the MIME type of an image file from its first 12 bytes
+    """
+    if header.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
 def is_image(path) -> bool:
     """
     Check if the file is a supported image file type
     """
-    kind = filetype.guess(path)
-    supported_types = ["image/jpeg"]
-    return kind is not None and kind.mime in supported_types
+    with open(path, "rb", buffering=0) as file:
+        header = file.read(12)
+    return guess_image_type(header) in SUPPORTED_INPUT_TYPES
 
 def find_photos(source_dir: Path) -> list[Path]:
     """
-    Find all photos in the source directory
+    Find all photos in the source directory.
+    Photos are saved under their name without extension, so these must be unique.
     """
     print(f"Searching for photos in {source_dir.name}")
-    return [path for path in source_dir.iterdir() if path.is_file() and is_image(path)]
+    with os.scandir(source_dir) as entries:
+        photos = [
+            Path(entry.path) for entry in entries if entry.is_file() and is_image(entry.path)
+        ]
+
+    names = {}
+    for photo in photos:
+        if photo.stem in names:
+            raise IOError(
+                f"{names[photo.stem].name} and {photo.name} would be saved as the same images")
+        names[photo.stem] = photo
+    return photos
 
 def is_landscape_orientation(image: Image) -> bool:
     """ Check if the image is in landscape orientation """
@@ -103,61 +196,227 @@ def get_limited_size(image: Image, max_size: Size) -> Size:
         return (width, int(width / aspect_ratio))
     return (int(height * aspect_ratio), height)
 
-def resize_image(
-        file: BinaryIO,
+@lru_cache(maxsize=None)
+def get_turbo_jpeg() -> Optional["TurboJPEG"]:
+    """ Load libjpeg-turbo once per process, if PyTurboJPEG and the library are available """
+    if TurboJPEG is None:
+        return None
+    try:
+        return TurboJPEG()
+    except (OSError, RuntimeError):
+        return None
+
+def decode_jpeg_fast(buffer: bytes, mode: str, min_size: Size) -> Optional[Image.Image]:
+    """
+    Decode an L or RGB JPEG with libjpeg-turbo into an image of the same mode, scaled down
+    as far as possible while keeping at least min_size.
+    Returns None if libjpeg-turbo is not available.
+    """
+    jpeg = get_turbo_jpeg()
+    if jpeg is None:
+        return None
+    width, height, _, _ = jpeg.decode_header(buffer)
+    min_width, min_height = min_size
+    scaling_factor = min(
+        (factor for factor in jpeg.scaling_factors
+            if width * factor[0] / factor[1] >= min_width
+            and height * factor[0] / factor[1] >= min_height),
+        key=lambda factor: factor[0] / factor[1],
+        default=(1, 1))
+    if mode == "L":
+        pixels = jpeg.decode(buffer, pixel_format=TJPF_GRAY, scaling_factor=scaling_factor)
+        # grayscale is decoded with a single channel axis that Pillow doesn't accept
+        return Image.fromarray(pixels[:, :, 0])
+    pixels = jpeg.decode(buffer, pixel_format=TJPF_RGB, scaling_factor=scaling_factor)
+    return Image.fromarray(pixels)
+
+def decode_image(file: io.BytesIO, image: Image.Image, min_size: Size) -> Image.Image:
+    """
+    Decode the opened image at the smallest size that still covers min_size.
+    JPEGs are decoded with libjpeg-turbo if available and fall back to Pillow's draft mode.
+    """
+    if image.format != "JPEG":
+        # resizing palette and bilevel images would fall back to nearest neighbour
+        if image.mode not in ("L", "LA", "RGB", "RGBA"):
+            return image.convert("RGBA" if "transparency" in image.info else "RGB")
+        return image
+    if image.mode in ("L", "RGB"):
+        decoded = decode_jpeg_fast(file.getvalue(), image.mode, min_size)
+        if decoded is not None:
+            return decoded
+    # let libjpeg scale down while decoding, as close to min_size as possible
+    image.draft(image.mode, min_size)
+    return image
+
+def resize_image(image: Image.Image, max_size: Size) -> Image.Image:
+    """
+    Resize the image to fit the given max size
+    """
+    new_size = get_limited_size(image, max_size)
+    return image.resize(new_size, Image.LANCZOS)
+
+def remove_alpha(image: Image.Image) -> Image.Image:
+    """ Flatten an image with an alpha channel onto a white background """
+    background = Image.new("RGBA", image.size, "white")
+    flattened = Image.alpha_composite(background, image.convert("RGBA"))
+    return flattened.convert("L" if image.mode == "LA" else "RGB")
+
+def get_output_path(target: Path, output_format: str) -> Path:
+    """ Path of the image file saved for target in the output format """
+    return target.with_suffix(_SUFFIXES[output_format])
+
+def save_image(
+        image: Image.Image,
         target: Path,
-        max_size: Size,
         output_format: str,
         quality: int) -> Path:
     """
-    Resize the image to the given width and convert to output file format
+    Save the image in the output file format
     """
-    assert output_format in SUPPORTED_OUTPUT_TYPES
-
-    new_name = target.with_suffix(f".{output_format.lower()}")
-    with Image.open(file) as image:
-        new_size = get_limited_size(image, max_size)
-        resized = image.resize(new_size, Image.LANCZOS)
-        resized.save(new_name, format = output_format, quality = quality)
+    if output_format == "JPEG" and image.mode in ("LA", "RGBA"):
+        image = remove_alpha(image)
+    new_name = get_output_path(target, output_format)
+    image.save(new_name, format = output_format, quality = quality)
     return new_name
 
-def create_image_directories(destination_dir) -> dict[int, Path]:
+def save_images(
+        image: Image.Image,
+        target: Path,
+        output_formats: list[str],
+        quality: int) -> dict[str, Path]:
+    """
+    Save the image in every output file format
+    """
+    return {
+        output_format: save_image(image, target, output_format, quality)
+        for output_format in output_formats
+    }
+
+def create_image_directories(destination_dir) -> tuple[Path, ...]:
     """
     Create an image directory for every max-width in destination_dir
-    and return a record of available widths and their directories
+    and return the directories in the order of WIDTHS
     """
     image_dir = destination_dir / "img"
-    max_widths = [res[0] for res in TARGET_RESOLUTIONS]
-    target_dirs = [image_dir / str(width) for width in max_widths]
+    target_dirs = tuple(image_dir / str(width) for width in WIDTHS)
     for target in target_dirs:
-        target.mkdir(parents=True)
+        target.mkdir(parents=True, exist_ok=True)
 
-    return dict(zip(max_widths, target_dirs))
+    return target_dirs
 
 def resize_images(
-        file: BinaryIO,
+        image: Image.Image,
         source: Path,
-        destination_dirs: dict[int, Path],
-        output_format: str,
+        destination_dirs: tuple[Path, ...],
+        output_formats: list[str],
         output_quality: int,
-        ) -> dict[int, Path]:
+        save_executor: Optional[Executor] = None,
+        ) -> ImagePaths:
+    """
+    Create a converted and resized copy in every output format for each targeted resolution
+    and return their paths per format in the order of WIDTHS.
+    Every copy is resized from the next larger one. If a save_executor is given,
+    the copies are encoded and saved there while the next smaller one is resized.
+    """
+    saves = []
+    resized = image
+    for max_size, target_dir in zip(TARGET_RESOLUTIONS, destination_dirs):
+        resized = resize_image(resized, max_size)
+        target = target_dir / source.name
+        if save_executor is None:
+            saves.append(save_images(resized, target, output_formats, output_quality))
+        else:
+            # Image.save() stores the encoder options on the image, so all formats
+            # of one copy are saved by the same task, one after another
+            saves.append(save_executor.submit(
+                save_images, resized, target, output_formats, output_quality))
+    if save_executor is not None:
+        saves = [save.result() for save in saves]
+    return {
+        output_format: [paths[output_format] for paths in saves]
+        for output_format in output_formats
+    }
+
+def get_image_paths(
+        source: Path,
+        destination_dirs: tuple[Path, ...],
+        output_formats: list[str]) -> ImagePaths:
+    """
+    Paths of the resized copies of source per format in the order of WIDTHS
+    """
+    return {
+        output_format: [
+            get_output_path(target_dir / source.name, output_format)
+            for target_dir in destination_dirs
+        ]
+        for output_format in output_formats
+    }
+
+def are_images_up_to_date(source: Path, paths: ImagePaths) -> bool:
+    """ Check if all resized copies exist and are newer than the source """
+    source_mtime = source.stat().st_mtime_ns
+    try:
+        return all(
+            path.stat().st_mtime_ns >= source_mtime
+            for format_paths in paths.values() for path in format_paths)
+    except FileNotFoundError:
+        return False
+
+def create_manifest_entry(
+        source: Path,
+        output_formats: list[str],
+        output_quality: int) -> ManifestEntry:
+    """ Record of a source photo and the parameters its copies are created with """
+    return {
+        "mtime_ns": source.stat().st_mtime_ns,
+        "formats": list(output_formats),
+        "quality": output_quality,
+    }
+
+def read_manifest(destination_dir: Path) -> dict[str, ManifestEntry]:
+    """ Read the manifest of a previous run, if any """
+    try:
+        with open(destination_dir / MANIFEST_FILE_NAME, "r", encoding="utf8") as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def write_manifest(destination_dir: Path, manifest: dict[str, ManifestEntry]) -> None:
+    """ Write the manifest for the next run """
+    with open(destination_dir / MANIFEST_FILE_NAME, "w", encoding="utf8") as file:
+        json.dump(manifest, file, indent=1)
+
+def optimize_images(paths: Iterable[Path], output_format: str) -> None:
     """
-    Create a converted and resized copy for each targeted resolution
+    Losslessly optimize and strip metadata from saved JPEG files with jpegoptim, if installed
     """
-    print("Creating resized copies ", end="", flush=True)
-    for max_width, max_height in TARGET_RESOLUTIONS:
-        target = destination_dirs[max_width] / source.name
-        resize_image(file, target, (max_width, max_height), output_format, output_quality)
-        print(".", end="", flush=True)
-    print()
+    if output_format == "JPEG" and JPEGOPTIM is not None:
+        subprocess.run([JPEGOPTIM, "--quiet", "--strip-all", *map(str, paths)], check=False)
+
+def to_plain_exif_value(value: Any) -> Any:
+    """ Convert EXIF values like rationals and byte strings to plain Python types """
+    if isinstance(value, numbers.Rational) and not isinstance(value, int):
+        # cameras write 0/0 for unknown values, e.g. the aperture of a manual lens
+        return float(value) if value.denominator else None
+    if isinstance(value, bytes):
+        return value.decode(errors="replace").strip("\x00 ")
+    if isinstance(value, str):
+        return value.strip("\x00 ")
+    if isinstance(value, tuple):
+        return tuple(to_plain_exif_value(v) for v in value)
+    return value
 
-def read_exif(file: BinaryIO) -> ExifData:
-    """ Read EXIF data from image file """
-    image = Image.open(file)
+def read_exif(image: Image.Image) -> ExifData:
+    """ Read the EXIF tags used by the site (EXIF_TAGS) from image """
     exif = image.getexif()
     if exif is not None:
-        data = dict((ExifTags.TAGS[k], v) for k, v in exif.items() if k in ExifTags.TAGS)
-        return data
+        tag_names = EXIF_TAG_NAMES
+        # camera tags are in the main IFD, exposure tags in the Exif IFD
+        items = chain(exif.items(), exif.get_ifd(ExifTags.IFD.Exif).items())
+        return {
+            tag_names[k]: to_plain_exif_value(v)
+            for k, v in items if tag_names.get(k) in EXIF_TAGS
+        }
     return {}
 
 def read_description_file(photo_path: Path) -> PhotoTitleAndDescription:
@@ -165,20 +424,19 @@ def read_description_file(photo_path: Path) -> PhotoTitleAndDescription:
     file_path = photo_path.with_suffix(".txt")
     if file_path.is_file():
         with open(file_path, "r", encoding="utf8") as file:
-            lines = file.readlines()
-            title = lines[0].strip() if len(lines) > 0 else None
-            description = lines[1].strip() if len(lines) > 1 else None
-            if title or description:
-                print(f"Found title \"{title}\" and {'a' if description else 'no'} description")
+            # only the first two lines are used, don't read the whole file
+            title = file.readline().strip() or None
+            description = file.readline().strip() or None
             return (title, description)
     return (None, None)
 
-def print_statistics(start: int, photos: list[Photo]) -> None:
+def print_statistics(
+        start: int,
+        photo_count: int,
+        title_count: int,
+        description_count: int) -> None:
     """ Print processing statistics """
     duration = round(time() - start)
-    photo_count = len(photos)
-    title_count = len([p for p in photos if p.title is not None])
-    description_count = len([p for p in photos if p.description is not None])
     line_length = 80
 
     print("*"*line_length)
@@ -186,28 +444,115 @@ def print_statistics(start: int, photos: list[Photo]) -> None:
     print(f"{title_count} photos had a title and {description_count} of them had a description.")
     print("*"*line_length)
 
+def _process_one(
+        source: Path,
+        unchanged: bool,
+        destination_dir: Path,
+        destination_dirs: tuple[Path, ...],
+        output_formats: list[str],
+        output_quality: int,
+        save_executor: Optional[Executor] = None) -> Photo:
+    """
+    Read metadata, convert/resize and save a single photo (usually in a worker process).
+    If the photo is unchanged since the last run and its copies are up to date,
+    only the metadata is read.
+    """
+    title_and_description = read_description_file(source)
+    paths = get_image_paths(source, destination_dirs, output_formats)
+    if unchanged and are_images_up_to_date(source, paths):
+        with Image.open(source) as image:
+            exif_data = read_exif(image)
+    else:
+        # read the whole file once, decoding and EXIF parsing then work on memory
+        with io.BytesIO(source.read_bytes()) as file, Image.open(file) as image:
+            exif_data = read_exif(image)
+            min_size = get_limited_size(image, TARGET_RESOLUTIONS[0])
+            decoded = decode_image(file, image, min_size)
+            paths = resize_images(
+                decoded, source, destination_dirs, output_formats, output_quality, save_executor)
+        for output_format, format_paths in paths.items():
+            if save_executor is None:
+                optimize_images(format_paths, output_format)
+            else:
+                # runs while the next photo is resized, _map_photos waits for it at the end
+                save_executor.submit(optimize_images, format_paths, output_format)
+    # the site refers to the images relative to its root directory, in the order of SIZES
+    site_paths = {
+        output_format: [
+            path.relative_to(destination_dir).as_posix() for path in reversed(format_paths)
+        ]
+        for output_format, format_paths in paths.items()
+    }
+    return Photo(title_and_description, site_paths, exif_data)
+
+def _map_photos(
+        process_one: Callable[..., Photo],
+        sources: Iterable[Path],
+        unchanged: Iterable[bool],
+        jobs: int) -> Iterator[Photo]:
+    """
+    Process photos in parallel worker processes, or in this process with
+    the resized copies of a photo being saved in parallel threads if jobs is 1
+    """
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            yield from executor.map(process_one, sources, unchanged, chunksize=1)
+    else:
+        with ThreadPoolExecutor(max_workers=len(TARGET_RESOLUTIONS)) as save_executor:
+            yield from map(partial(process_one, save_executor=save_executor), sources, unchanged)
+
 def process_photos(
         source_dir: Path,
         destination_dir: Path,
-        output_format: str,
-        output_quality: int) -> list[Photo]:
+        output_formats: list[str],
+        output_quality: int,
+        jobs: Optional[int] = None) -> list[Photo]:
     """
     Scan photo files, read metadata, convert/resize and save to destination
+    in all output formats (in order of preference, the last one is the fallback)
+    using the given number of parallel jobs (default: number of CPUs).
+    Photos converted with the same parameters by a previous run into destination
+    are not converted again if they didn't change.
     """
     start = time()
+    print(f"Using Pillow {PIL.__version__}{' (SIMD)' if is_pillow_simd() else ''}")
     photos = []
+    title_count = 0
+    description_count = 0
     found_exif_tags = set()
     destination_dirs = create_image_directories(destination_dir)
 
-    for source in find_photos(source_dir):
-        print(f"Found {source.name}")
-        title_and_description = read_description_file(source)
-        with open(source, "rb") as file:
-            exif_data = read_exif(file)
-            found_exif_tags.update(exif_data.keys())
-            resize_images(file, source_dir, destination_dirs, output_format, output_quality)
-            photos.append(Photo(title_and_description, destination_dirs, exif_data))
+    process_one = partial(
+        _process_one,
+        destination_dir=destination_dir,
+        destination_dirs=destination_dirs,
+        output_formats=output_formats,
+        output_quality=output_quality)
+
+    sources = find_photos(source_dir)
+    previous_manifest = read_manifest(destination_dir)
+    # copies may be overwritten from here on, an aborted run must not leave a valid manifest
+    (destination_dir / MANIFEST_FILE_NAME).unlink(missing_ok=True)
+    manifest = {
+        source.name: create_manifest_entry(source, output_formats, output_quality)
+        for source in sources
+    }
+    unchanged = [previous_manifest.get(name) == entry for name, entry in manifest.items()]
+
+    results = _map_photos(process_one, sources, unchanged, jobs or os.cpu_count() or 1)
+    # photos are returned in the order of their sources
+    for source, photo in zip(sources, results):
+        print(f"Processed {source.name}")
+        if photo.title or photo.description:
+            print(f"Found title \"{photo.title}\" and "
+                  f"{'a' if photo.description else 'no'} description")
+        title_count += photo.title is not None
+        description_count += photo.description is not None
+        found_exif_tags.update(photo.exif.keys())
+        photos.append(photo)
 
+    # only reached if all photos were converted
+    write_manifest(destination_dir, manifest)
     photos.sort(key=str)
-    print_statistics(start, photos)
+    print_statistics(start, len(photos), title_count, description_count)
     return photos
@@ -2,7 +2,9 @@
 Website generator module
 """
 
+import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import toml
@@ -11,9 +13,17 @@ import jinja2
 from photo_processor import Photo
 
 TEMPLATE_INDEX_FILE_NAME = "index.jinja"
+OUTPUT_BUFFER_SIZE = 1024 * 1024
 SYSTEM_TEMPLATE_PATH = Path(__file__).parent.parent / "templates"
 SYSTEM_DEFAULT_TEMPLATES = list(SYSTEM_TEMPLATE_PATH.glob("*"))
 
+def get_cache_path() -> Path:
+    """ phogg's cache directory in $XDG_CACHE_HOME, ignored if empty or relative """
+    cache_home = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+    if not cache_home.is_absolute():
+        cache_home = Path.home() / ".cache"
+    return cache_home / "phogg"
+
 def read_config(path: Path):
     """ Parse the site configuration file """
     print(f"Reading site configuration file {path.name}")
@@ -25,7 +35,20 @@ def copy_static_files(template_dir: Path, destination_dir: Path):
     static_dir = template_dir / "static"
     static_files = ", ".join(p.name for p in static_dir.iterdir())
     print(f"Copying static template files {static_files}")
-    shutil.copytree(static_dir, destination_dir, dirs_exist_ok=True)
+    # static files don't need their metadata, copyfile() uses sendfile() where available
+    shutil.copytree(static_dir, destination_dir, dirs_exist_ok=True,
+                    copy_function=shutil.copyfile)
+
+def create_bytecode_cache():
+    """ Create a cache for compiled templates, if the cache directory is writable """
+    cache_dir = get_cache_path() / "jinja"
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+    except OSError:
+        return None
+    if not os.access(cache_dir, os.W_OK):
+        return None
+    return jinja2.FileSystemBytecodeCache(directory=str(cache_dir))
 
 def load_template(environment: jinja2.Environment):
     """ Load template file """
@@ -37,16 +60,21 @@ def load_template(environment: jinja2.Environment):
             f"no {TEMPLATE_INDEX_FILE_NAME} found in template"
         ) from exc
 
-def create_site_directory(path: Path, force: bool):
-    """ Create the destination directory if it doesn't exist """
+def create_site_directory(path: Path, force: bool, incremental: bool = False):
+    """
+    Create the destination directory if it doesn't exist.
+    An existing directory is cleaned up if forced or else reused if incremental.
+    """
     print(f"Creating destination directory {path}{' (forcing cleanup)' if force else ''}")
     if path.exists():
         if force:
             shutil.rmtree(path)
+        elif incremental:
+            print(f"Reusing existing files in {path}")
         else:
             raise IOError(f"{path} already exists")
 
-    path.mkdir(parents=True)
+    path.mkdir(parents=True, exist_ok=True)
     return path
 
 def generate_site(
@@ -61,15 +89,21 @@ def generate_site(
     template_dir = SYSTEM_TEMPLATE_PATH / system_template_name
     environment = jinja2.Environment(
         loader=jinja2.FileSystemLoader(template_dir),
-        autoescape=True)
+        autoescape=True,
+        bytecode_cache=create_bytecode_cache(),
+        auto_reload=False)
     template = load_template(environment)
     site_config = read_config(config_path)
 
-    print("Rendering template")
-    with open(destination_dir / "index.html", "w", encoding="utf8") as file:
-        result = template.render(
-            **site_config,
-            photos=photos_meta)
-        file.write(result)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # copying the static files is independent of rendering, do both at once
+        static_files_copied = executor.submit(copy_static_files, template_dir, destination_dir)
+
+        print("Rendering template")
+        with open(destination_dir / "index.html", "w", encoding="utf8",
+                  buffering=OUTPUT_BUFFER_SIZE) as file:
+            template.stream(
+                **site_config,
+                photos=photos_meta).dump(file)
 
-    copy_static_files(template_dir, destination_dir)
+        static_files_copied.result()